@@ -5,8 +5,8 @@
 #
 # ⚙️ Prérequis
 # - Python 3.9+
-# - Packages : streamlit, python-pptx, requests, nbformat
-#   pip install streamlit python-pptx requests nbformat
+# - Packages : streamlit, python-pptx, lxml, requests, nbformat, orjson
+#   pip install streamlit python-pptx lxml requests nbformat orjson
 # - Clé API DeepL via la variable d'environnement DEEPL_API_KEY
 #   export DEEPL_API_KEY="votre_clef_deepl"
 # - (Optionnel pour .ppt) LibreOffice installé avec la commande `soffice` disponible dans le PATH
@@ -21,21 +21,32 @@
 # - PowerPoint : Les fichiers .ppt (ancien format) sont automatiquement convertis en .pptx via LibreOffice si disponible.
 # - Jupyter : Seuls les cellules markdown et les commentaires dans le code sont traduits, le code reste intact.
 
+import hashlib
 import io
-import json
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import tempfile
+import threading
+import tokenize
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from itertools import accumulate
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote_plus
 
 import nbformat
+import orjson
 import requests
 import streamlit as st
+from lxml import etree
 from pptx import Presentation
+from pptx.oxml.ns import qn
 from pptx.shapes.group import GroupShape
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Charger les variables d'environnement depuis .env si le fichier existe
 try:
@@ -56,14 +67,127 @@ if not DEEPL_API_URL:
         DEEPL_API_URL = "https://api.deepl.com/v2/translate"
 
 BATCH_SIZE = 45  # par sécurité, rester < 50 textes par requête
+BATCH_MAX_BYTES = 120_000  # taille du corps de requête, sous la limite DeepL de 128 KiB
+# Lots envoyés simultanément (threads) : DeepL accepte une dizaine d'appels parallèles
+try:
+    MAX_CONCURRENT_REQUESTS = max(1, int(os.getenv("DEEPL_MAX_CONCURRENT_REQUESTS", "8")))
+except ValueError:
+    # Valeur non entière (ex. "huit", "") : garder la valeur par défaut plutôt que d'empêcher le démarrage
+    MAX_CONCURRENT_REQUESTS = 8
+MAX_PENDING_BATCHES = 2 * MAX_CONCURRENT_REQUESTS  # lots préparés en avance au plus
+
+# Regroupement des textes courts dans un seul champ 'text', découpé au retour sur un séparateur rare
+PACK_MARKER = "\n⟦§⟧\n"
+SHORT_TEXT_MAX_CHARS = 80
+PACK_MAX_TEXTS = 10
+_PACK_SPLIT_RE = re.compile(r"\s*⟦§⟧\s*")
+
+# Paramètres fixes du formulaire (source_lang, target_lang, preserve_formatting), marge comprise
+_PAYLOAD_OVERHEAD_BYTES = 128
+
+# Ressources partagées : Streamlit réexécute le script à chaque interaction, les fabriques décorées par
+# st.cache_resource (cache sqlite, session HTTP) ne construisent donc qu'une instance par processus au
+# lieu d'une nouvelle à chaque relance.
+
+# Cache persistant des traductions (sqlite), conservé entre les redémarrages : clé
+# "source_lang:target_lang:sha1(texte)" -> traduction
+DEEPL_CACHE_DB = os.getenv("DEEPL_CACHE_DB", "deepl_cache.db")
+
+TranslationCache = Tuple[sqlite3.Connection, threading.Lock]
+
+
+# Une seule connexion, protégée par un verrou car partagée par les threads de toutes les sessions
+@st.cache_resource(show_spinner=False)
+def get_translation_cache() -> TranslationCache:
+    """Ouvre (ou crée) la base de cache ; repli sur une base en mémoire si le fichier est inaccessible."""
+    try:
+        conn = sqlite3.connect(DEEPL_CACHE_DB, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.Error:
+        conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS t(k TEXT PRIMARY KEY, v TEXT)")
+    return conn, threading.Lock()
+
+
+def translation_cache_key(source_lang: str, target_lang: str, txt: str) -> str:
+    return f"{source_lang}:{target_lang}:{hashlib.sha1(txt.encode('utf-8')).hexdigest()}"
+
+
+def translation_cache_get(key: str, cache: Optional[TranslationCache] = None) -> Optional[str]:
+    conn, lock = cache or get_translation_cache()
+    with lock:
+        row = conn.execute("SELECT v FROM t WHERE k = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def translation_cache_put_many(items: List[Tuple[str, str]], cache: Optional[TranslationCache] = None):
+    if not items:
+        return
+    conn, lock = cache or get_translation_cache()
+    with lock:
+        # Une seule transaction pour toutes les insertions
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO t(k, v) VALUES (?, ?)", items)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            # Le cache est facultatif : un échec d'écriture ne doit pas faire échouer la traduction
+            conn.execute("ROLLBACK")
+
+
+# Session HTTP persistante : les connexions TCP/TLS vers DeepL sont réutilisées d'un lot à l'autre.
+# Les erreurs temporaires (429 trop de requêtes, 5xx) sont retentées avec un délai exponentiel
+# en respectant l'en-tête Retry-After (renvoyer une requête de traduction est sans effet de bord).
+@st.cache_resource(show_spinner=False)
+def get_deepl_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(16, MAX_CONCURRENT_REQUESTS),  # une connexion réutilisable par thread d'envoi
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True,
+            raise_on_status=False,  # après le dernier essai, la réponse d'erreur est traitée par raise_for_status
+        ),
+    ))
+    session.headers.update({"Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}"})
+    return session
+
+
+# Attributs de <a:rPr> sans effet sur le rendu (langue, marques du correcteur orthographique)
+_VOLATILE_RPR_ATTRS = frozenset({"lang", "altLang", "dirty", "err", "noProof", "smtClean", "smtId", "bmk"})
+
+# Caractères interdits dans un nœud texte XML 1.0
+_XML_ILLEGAL_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Commentaire de ligne : du premier '#' jusqu'à la fin de la ligne (sans tenir compte des chaînes)
+_COMMENT_RE = re.compile(r"(#[^\n]*)")
+# Variante prudente : seulement si aucun guillemet ne précède le '#' sur la ligne
+_UNQUOTED_COMMENT_RE = re.compile(r"^[^#'\"\n]*(#[^\n]*)", re.MULTILINE)
+
+# Filtres des textes sans contenu à traduire (nombres, puces, URLs, e-mails…)
+_TRANSLATABLE_RE = re.compile(r"[A-Za-zÀ-ÿ]{2,}")
+_URL_OR_EMAIL_RE = re.compile(r"\s*(?:(?:https?://|www\.)\S+|[\w.+-]+@[\w-]+(?:\.[\w-]+)+)\s*", re.IGNORECASE)
+_COMMENT_DIRECTIVE_RE = re.compile(r"(?:!|-\*-|noqa\b|type:|pylint:|mypy:|pyright:|fmt:|isort:|pragma\b)", re.IGNORECASE)
+
+
+def is_translatable(txt: str) -> bool:
+    """Indique si le texte contient au moins un mot (et n'est pas seulement une URL ou un e-mail)."""
+    return _TRANSLATABLE_RE.search(txt) is not None and _URL_OR_EMAIL_RE.fullmatch(txt) is None
+
 
 # Fonction de traduction par lots via DeepL
-def deepl_translate_batch(texts: List[str], source_lang: str = "FR", target_lang: str = "EN-US") -> List[str]:
+def deepl_translate_batch(
+    texts: List[str], source_lang: str = "FR", target_lang: str = "EN-US", session: Optional[requests.Session] = None
+) -> List[str]:
     if not texts:
         return []
     # Construire un payload 'application/x-www-form-urlencoded' avec répétition de la clé 'text'
     data: List[Tuple[str, str]] = [
-        ("auth_key", DEEPL_API_KEY),
         ("source_lang", source_lang),
         ("target_lang", target_lang),
         ("preserve_formatting", "1"),  # aide à garder la casse/ponctuation
@@ -72,21 +196,162 @@ def deepl_translate_batch(texts: List[str], source_lang: str = "FR", target_lang
 
     # Requêtes + gestion d'erreurs simples
     try:
-        resp = requests.post(DEEPL_API_URL, data=data, timeout=60)
+        resp = (session or get_deepl_session()).post(DEEPL_API_URL, data=data, timeout=60)
         resp.raise_for_status()
         js = resp.json()
         translations = js.get("translations", [])
         return [t.get("text", "") for t in translations]
     except requests.HTTPError as e:
-        st.error(f"Erreur DeepL ({e.response.status_code}) : {e.response.text}")
-        raise
+        raise RuntimeError(f"Erreur DeepL ({e.response.status_code}) : {e.response.text}") from e
     except Exception as e:
-        st.error(f"Erreur de connexion à l'API DeepL : {e}")
-        raise
+        raise RuntimeError(f"Erreur de connexion à l'API DeepL : {e}") from e
+
+
+def pack_short_texts(texts: Iterable[str]) -> Iterator[List[str]]:
+    """Regroupe les textes courts consécutifs (libellés, puces, cellules) ; les textes longs restent seuls."""
+    current: List[str] = []
+    for txt in texts:
+        if len(txt) < SHORT_TEXT_MAX_CHARS and PACK_MARKER.strip() not in txt:
+            current.append(txt)
+            if len(current) == PACK_MAX_TEXTS:
+                yield current
+                current = []
+        else:
+            if current:
+                yield current
+                current = []
+            yield [txt]
+    if current:
+        yield current
+
+
+def unpack_translation(group: List[str], translated: str) -> Optional[List[str]]:
+    """Découpe la traduction d'un groupe sur le séparateur ; None si le nombre de morceaux ne correspond pas."""
+    if len(group) == 1:
+        return [translated]
+    pieces = _PACK_SPLIT_RE.split(translated)
+    if len(pieces) != len(group):
+        return None
+    # Restaurer les espaces de bord du texte source (ex. "Le " suivi d'un run en gras)
+    unpacked = []
+    for orig, piece in zip(group, pieces):
+        lead = orig[:len(orig) - len(orig.lstrip())]
+        trail = orig[len(orig.rstrip()):] if orig.strip() else ""
+        unpacked.append(f"{lead}{piece.strip()}{trail}")
+    return unpacked
+
+
+def iter_batches(groups: Iterable[List[str]]) -> Iterator[List[List[str]]]:
+    """Regroupe les groupes de textes en lots remplis au maximum : BATCH_SIZE champs et BATCH_MAX_BYTES octets.
+
+    Chaque groupe devient un champ 'text' (ses textes joints par PACK_MARKER). Un lot est produit dès
+    qu'il est plein, ce qui permet de l'envoyer sans attendre la fin de l'extraction.
+    """
+    batch: List[List[str]] = []
+    payload_bytes = _PAYLOAD_OVERHEAD_BYTES
+    for group in groups:
+        # Taille réelle du champ une fois encodé en application/x-www-form-urlencoded
+        field_bytes = len("&text=") + len(quote_plus(PACK_MARKER.join(group)))
+        if batch and (len(batch) >= BATCH_SIZE or payload_bytes + field_bytes > BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            payload_bytes = _PAYLOAD_OVERHEAD_BYTES
+        batch.append(group)
+        payload_bytes += field_bytes
+    if batch:
+        yield batch
+
+
+def translate_texts(texts: Iterable[str], source_lang: str = "FR", target_lang: str = "EN-US", progress=None) -> List[str]:
+    """Traduit des textes en envoyant les lots en parallèle à DeepL (l'ordre est conservé).
+
+    texts peut être un générateur : chaque lot part vers DeepL dès qu'il est plein, pendant que
+    l'extraction se poursuit ; comme texts n'est lu qu'à la demande, un générateur est mis en
+    pause tant que MAX_PENDING_BATCHES lots attendent leur réponse. Les doublons (en-têtes, pieds
+    de page, libellés répétés…) ne sont envoyés qu'une fois et les traductions déjà obtenues (y
+    compris lors d'exécutions précédentes) sont reprises du cache sqlite.
+    """
+    # Session et cache résolus une fois depuis le thread Streamlit, puis partagés par les threads d'envoi
+    session = get_deepl_session()
+    cache = get_translation_cache()
+    all_texts: List[str] = []
+    unique: Dict[str, Optional[str]] = {}
+    pending: List[str] = []  # textes uniques absents du cache, dans l'ordre d'apparition
+    unpack_failed: List[str] = []
+    done = 0
+    stream_done = False  # tant que texts n'est pas épuisé, le total est inconnu
+
+    def iter_pending() -> Iterator[str]:
+        # Consommer texts au fil de l'eau en ne laissant passer que les textes nouveaux et non cachés
+        for txt in texts:
+            all_texts.append(txt)
+            if txt in unique:
+                continue
+            unique[txt] = translation_cache_get(translation_cache_key(source_lang, target_lang, txt), cache)
+            if unique[txt] is None:
+                pending.append(txt)
+                yield txt
+
+    def apply_batch(batch_groups: List[List[str]], batch_translated: List[str]):
+        nonlocal done
+        for group, field_translated in zip(batch_groups, batch_translated):
+            pieces = unpack_translation(group, field_translated)
+            if pieces is None:
+                # Séparateur altéré par DeepL : ces textes seront retraduits un par un
+                unpack_failed.extend(group)
+                continue
+            for orig, new_txt in zip(group, pieces):
+                unique[orig] = new_txt
+            done += len(group)
+        if progress is None:
+            return
+        if stream_done and pending:
+            progress.progress(min(1.0, done / len(pending)), text=f"{done}/{len(pending)} segments")
+        else:
+            # Total encore inconnu : seul le compteur avance (une fraction reculerait à chaque arrivée)
+            progress.progress(0.0, text=f"{done} segments traduits…")
+
+    # Les lots sont indépendants : on les expédie simultanément et on met à jour la progression
+    # (depuis le thread Streamlit) au fur et à mesure des réponses.
+    futures: Dict[Future, List[List[str]]] = {}
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        try:
+            for batch_groups in iter_batches(pack_short_texts(iter_pending())):
+                # Nombre de lots en attente borné : l'extraction patiente si DeepL ne suit pas
+                while len(futures) >= MAX_PENDING_BATCHES:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        apply_batch(futures.pop(fut), fut.result())
+                fields = [PACK_MARKER.join(group) for group in batch_groups]
+                futures[executor.submit(deepl_translate_batch, fields, source_lang, target_lang, session)] = batch_groups
+            stream_done = True
+            for fut in as_completed(futures):
+                apply_batch(futures[fut], fut.result())
+
+            for batch_groups in iter_batches([txt] for txt in unpack_failed):
+                batch_texts = [group[0] for group in batch_groups]
+                apply_batch(batch_groups, deepl_translate_batch(batch_texts, source_lang, target_lang, session))
+        except RuntimeError as e:
+            for fut in futures:
+                fut.cancel()
+            st.error(str(e))
+            raise
 
+    if progress is not None and not pending:
+        progress.progress(1.0, text="Traductions reprises du cache")
 
-def process_powerpoint_file(in_path: Path, tmpdir: Path, tgt_variant: str, include_notes: bool):
-    """Traite un fichier PowerPoint pour la traduction."""
+    # Mémoriser les nouvelles traductions
+    translation_cache_put_many([
+        (translation_cache_key(source_lang, target_lang, orig), unique[orig])
+        for orig in pending
+        if unique[orig] is not None
+    ], cache)
+
+    return [unique[txt] if unique[txt] is not None else txt for txt in all_texts]
+
+
+def process_powerpoint_file(in_path: Path, tgt_variant: str, include_notes: bool) -> Tuple[str, bytes]:
+    """Traite un fichier PowerPoint pour la traduction et retourne (nom, contenu) du fichier traduit."""
 
     # Convertir .ppt → .pptx via LibreOffice si nécessaire
     def convert_ppt_to_pptx(ppt_path: Path) -> Path:
@@ -128,90 +393,138 @@ def process_powerpoint_file(in_path: Path, tmpdir: Path, tgt_variant: str, inclu
                 yield from iter_text_frames(shp)
             return
 
-        # Table - utiliser has_table pour une vérification sûre
-        if hasattr(shape, 'has_table') and shape.has_table:
+        # Table - has_table / has_text_frame sont des indicateurs python-pptx peu coûteux, lus via
+        # getattr plutôt que hasattr + accès à la propriété
+        if getattr(shape, "has_table", False):
             try:
                 for row in shape.table.rows:
                     for cell in row.cells:
-                        if cell.text_frame is not None:
-                            yield cell.text_frame
+                        yield cell.text_frame
                 return
             except (ValueError, AttributeError):
                 # Ignorer les erreurs pour les tableaux problématiques
                 pass
 
         # Formes avec texte (auto-shapes, placeholders, text boxes)
-        if hasattr(shape, "text_frame") and shape.text_frame is not None:
+        if getattr(shape, "has_text_frame", False):
             yield shape.text_frame
 
-    # Collecter tous les runs de texte pour traduction
-    RunRef = Tuple  # alias pour lisibilité: (run_obj, original_text)
-    run_refs: List[Tuple[object, str]] = []
+    def run_format_key(r) -> Tuple:
+        """Clé de mise en forme d'un run <a:r> (attributs de <a:rPr> hors langue/correcteur, et ses enfants)."""
+        rPr = r.find(qn("a:rPr"))
+        if rPr is None:
+            return ()
+        attrs = tuple(sorted((k, v) for k, v in rPr.attrib.items() if k not in _VOLATILE_RPR_ATTRS))
+        return attrs, b"".join(etree.tostring(child) for child in rPr)
+
+    def merge_same_format_runs(p, runs: List[etree._Element]) -> List[etree._Element]:
+        """Fusionne les runs consécutifs de même mise en forme pour les traduire en une seule phrase.
+
+        Le texte est regroupé dans le premier run et les suivants sont supprimés : PowerPoint découpe
+        souvent une phrase en plusieurs runs identiques (correcteur orthographique, historique d'édition).
+        Retourne les runs restants du paragraphe <a:p>.
+        """
+        kept: List[etree._Element] = []
+        prev_key = None
+        for r in runs:
+            key = run_format_key(r)
+            if kept and key == prev_key and kept[-1].getnext() is r:
+                prev_t, t = kept[-1].find(qn("a:t")), r.find(qn("a:t"))
+                if prev_t is not None and t is not None:
+                    prev_t.text = (prev_t.text or "") + (t.text or "")
+                p.remove(r)
+                continue
+            kept.append(r)
+            prev_key = key
+        return kept
 
-    for slide in prs.slides:
-        for shape in slide.shapes:
+    # Collecter tous les runs de texte pour traduction
+    RunRef = Tuple  # alias pour lisibilité: (élément <a:t> du run, original_text)
+    run_refs: List[Tuple[etree._Element, str]] = []
+
+    def collect_runs(tf, refs: List[Tuple[etree._Element, str]]):
+        """Ajoute à refs l'élément <a:t> de chaque run à traduire d'un text_frame, avec son texte.
+
+        La traduction est ensuite écrite directement sur cet élément lxml, sans passer par le
+        setter run.text de python-pptx ; la mise en forme (<a:rPr>) n'est pas touchée.
+        """
+        # Parcours direct des éléments <a:p>/<a:r> : tf.paragraphs et para.runs recréent à chaque
+        # appel une liste d'objets python-pptx
+        for p in tf._txBody.findall(qn("a:p")):
+            runs = p.findall(qn("a:r"))
+            if not runs:
+                continue
+            for r in merge_same_format_runs(p, runs):
+                t = r.find(qn("a:t"))
+                if t is None:
+                    continue
+                txt = t.text
+                # isspace() évite de construire une copie comme strip() avant le test par regex
+                if not txt or txt.isspace() or not is_translatable(txt):
+                    continue
+                refs.append((t, txt))
+
+    def extract_runs_from_slide(slide) -> List[Tuple[etree._Element, str]]:
+        """Collecte les runs à traduire d'une diapositive (et de ses notes si demandé)."""
+        slide_refs: List[Tuple[etree._Element, str]] = []
+        shapes = list(slide.shapes)
+        # Notes de la diapositive : même parcours que les formes de la diapositive
+        if include_notes and slide.has_notes_slide:
+            shapes.extend(slide.notes_slide.shapes)
+        for shape in shapes:
             for tf in iter_text_frames(shape):
-                for para in tf.paragraphs:
-                    for run in para.runs:
-                        txt = run.text
-                        if txt is not None and txt.strip() != "":
-                            run_refs.append((run, txt))
-
-        # Notes de la diapositive
-        if include_notes:
-            if slide.has_notes_slide:
-                notes = slide.notes_slide
-                for shape in notes.shapes:
-                    if hasattr(shape, "text_frame") and shape.text_frame is not None:
-                        for para in shape.text_frame.paragraphs:
-                            for run in para.runs:
-                                txt = run.text
-                                if txt is not None and txt.strip() != "":
-                                    run_refs.append((run, txt))
+                collect_runs(tf, slide_refs)
+        return slide_refs
+
+    def yield_runs():
+        """Génère au fil de l'eau les (élément <a:t>, texte) à traduire, diapositive par diapositive."""
+        for slide in prs.slides:
+            for ref in extract_runs_from_slide(slide):
+                run_refs.append(ref)
+                yield ref
+
+    # Extraction et traduction se chevauchent : les premiers lots partent vers DeepL pendant que
+    # les diapositives suivantes sont encore parcourues.
+    progress = st.progress(0, text="Traduction en cours…")
+    translated = translate_texts((txt for (_t, txt) in yield_runs()), source_lang="FR", target_lang=tgt_variant, progress=progress)
 
     total_runs = len(run_refs)
     if total_runs == 0:
+        progress.empty()
         st.warning("Aucun texte détecté à traduire.")
         st.stop()
 
-    st.write(f"Segments à traduire : **{total_runs}** (en conservant la mise en forme)")
-    
-    # Appliquer la traduction par lots en conservant la mise en forme (remplacement run par run)
-    progress = st.progress(0, text="Traduction en cours…")
-    for start in range(0, total_runs, BATCH_SIZE):
-        batch_refs = run_refs[start:start + BATCH_SIZE]
-        batch_texts = [txt for (_run, txt) in batch_refs]
-        translated = deepl_translate_batch(batch_texts, source_lang="FR", target_lang=tgt_variant)
-        for (run, _orig), new_txt in zip(batch_refs, translated):
-            run.text = new_txt
-        progress.progress(min(1.0, (start + len(batch_refs)) / total_runs), text=f"{min(start + len(batch_refs), total_runs)}/{total_runs} segments")
-
-    # Enregistrer la présentation traduite
-    out_name = Path(in_path.name).with_suffix("")
-    out_file = tmpdir / f"{out_name}_EN.pptx"
-    prs.save(str(out_file))
+    st.write(f"Segments traduits : **{total_runs}** (en conservant la mise en forme)")
 
-    st.success("Traduction terminée. Téléchargez votre fichier ci-dessous.")
-    with open(out_file, "rb") as f:
-        st.download_button(
-            label="⬇️ Télécharger le PowerPoint traduit",
-            data=f.read(),
-            file_name=out_file.name,
-            mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
-        )
+    # Appliquer la traduction en conservant la mise en forme (remplacement run par run)
+    for (t, _orig), new_txt in zip(run_refs, translated):
+        # lxml refuse les caractères de contrôle interdits en XML (python-pptx les échappait)
+        t.text = _XML_ILLEGAL_CHARS_RE.sub("", new_txt)
 
-    # Proposer un bouton pour réinitialiser la session (facilite une autre traduction)
-    if st.button("🔁 Traduire un autre fichier"):
-        st.experimental_rerun()
+    # Enregistrer la présentation traduite en mémoire (pas d'aller-retour par le disque)
+    out_name = Path(in_path.name).with_suffix("")
+    buf = io.BytesIO()
+    prs.save(buf)
 
+    return f"{out_name}_EN.pptx", buf.getvalue()
 
-def process_jupyter_notebook(in_path: Path, tmpdir: Path, tgt_variant: str):
-    """Traite un fichier Jupyter Notebook pour la traduction."""
+
+def process_jupyter_notebook(
+    in_path: Path, tgt_variant: str, validate: bool = False, fast_comments: bool = False
+) -> Tuple[str, bytes]:
+    """Traite un fichier Jupyter Notebook pour la traduction et retourne (nom, contenu) du fichier traduit."""
     
-    # Charger le notebook
+    # Charger le notebook en JSON brut (sans la validation de schéma de nbformat.read)
     try:
-        with open(in_path, 'r', encoding='utf-8') as f:
-            notebook = nbformat.read(f, as_version=4)
+        with open(in_path, 'rb') as f:
+            notebook = orjson.loads(f.read())
+        if notebook.get("nbformat", 4) < 4:
+            # Anciens formats : conversion v4 via nbformat
+            notebook = nbformat.convert(nbformat.from_dict(notebook), 4)
+        # 'source' peut être une liste de lignes dans le fichier : on travaille sur une chaîne
+        for cell in notebook["cells"]:
+            if isinstance(cell.get("source"), list):
+                cell["source"] = "".join(cell["source"])
     except Exception as e:
         st.error(f"Erreur lors du chargement du notebook : {e}")
         st.stop()
@@ -220,37 +533,63 @@ def process_jupyter_notebook(in_path: Path, tmpdir: Path, tgt_variant: str):
     texts_to_translate = []
     text_refs = []  # Références pour remplacer les textes traduits
     
-    def extract_comments_from_code(code_text: str) -> List[Tuple[str, int, int]]:
-        """Extrait les commentaires d'un code Python et retourne (commentaire, start, end)."""
+    def extract_comments_from_code(code_text: str, fast: bool = False) -> List[Tuple[str, int, int]]:
+        """Extrait les commentaires d'un code Python et retourne (commentaire, start, end).
+
+        Avec fast=True, une seule regex remplace tokenize : bien plus rapide, mais un '#' situé
+        dans une chaîne de caractères est alors pris pour un commentaire.
+        """
         comments = []
-        lines = code_text.split('\n')
-        for i, line in enumerate(lines):
-            # Commentaires de ligne (#)
-            if '#' in line:
-                # Trouver le début du commentaire
-                comment_start = line.find('#')
-                comment_text = line[comment_start + 1:].strip()
-                if comment_text:
-                    # Calculer les positions dans le texte original
-                    start_pos = sum(len(lines[j]) + 1 for j in range(i)) + comment_start + 1
-                    end_pos = start_pos + len(comment_text)
-                    comments.append((comment_text, start_pos, end_pos))
+
+        def add_comment(offset: int, comment: str):
+            # comment commence par '#' (à la position offset) ; on ne remplace que le texte, sans les espaces
+            body = comment[1:]
+            comment_text = body.strip()
+            if comment_text:
+                start_pos = offset + 1 + (len(body) - len(body.lstrip()))
+                comments.append((comment_text, start_pos, start_pos + len(comment_text)))
+
+        def add_regex_comments(pattern: re.Pattern = _COMMENT_RE, pos: int = 0):
+            for m in pattern.finditer(code_text, pos):
+                add_comment(m.start(1), m.group(1))
+
+        if fast:
+            add_regex_comments()
+            return comments
+
+        # Position absolue du début de chaque ligne (calculée une seule fois)
+        line_starts = [0, *accumulate(len(line) + 1 for line in code_text.split('\n'))]
+        tokenized_upto = 0  # début de la première ligne que tokenize n'a pas terminée
+        try:
+            # tokenize ignore les '#' situés dans les chaînes de caractères
+            for tok in tokenize.generate_tokens(io.StringIO(code_text).readline):
+                if tok.type == tokenize.COMMENT:
+                    add_comment(line_starts[tok.start[0] - 1] + tok.start[1], tok.string)
+                elif tok.type in (tokenize.NEWLINE, tokenize.NL):
+                    tokenized_upto = line_starts[tok.end[0]]
+        except (tokenize.TokenError, SyntaxError):
+            # Code non tokenisable (crochet non fermé, syntaxe IPython…) : les commentaires déjà trouvés
+            # sont conservés ; les lignes restantes passent par une regex prudente qui ignore les
+            # lignes où un guillemet précède le '#' (il pourrait être dans une chaîne)
+            add_regex_comments(_UNQUOTED_COMMENT_RE, tokenized_upto)
         return comments
 
     # Parcourir toutes les cellules
-    for cell_idx, cell in enumerate(notebook.cells):
-        if cell.cell_type == 'markdown':
+    for cell_idx, cell in enumerate(notebook["cells"]):
+        source = cell.get("source", "")
+        if cell["cell_type"] == 'markdown':
             # Cellules markdown - traduire tout le contenu
-            if cell.source and cell.source.strip():
-                texts_to_translate.append(cell.source)
+            if source and not source.isspace() and is_translatable(source):
+                texts_to_translate.append(source)
                 text_refs.append(('markdown', cell_idx, None))
         
-        elif cell.cell_type == 'code':
+        elif cell["cell_type"] == 'code':
             # Cellules code - extraire seulement les commentaires
-            if cell.source:
-                comments = extract_comments_from_code(cell.source)
+            if source:
+                comments = extract_comments_from_code(source, fast=fast_comments)
                 for comment_text, start_pos, end_pos in comments:
-                    if comment_text.strip():
+                    # Ignorer shebangs et directives d'outils (# noqa, # type: ignore, # -*- coding…)
+                    if is_translatable(comment_text) and not _COMMENT_DIRECTIVE_RE.match(comment_text):
                         texts_to_translate.append(comment_text)
                         text_refs.append(('comment', cell_idx, (start_pos, end_pos)))
 
@@ -263,53 +602,65 @@ def process_jupyter_notebook(in_path: Path, tmpdir: Path, tgt_variant: str):
     
     # Traduction par lots
     progress = st.progress(0, text="Traduction en cours…")
-    translated_texts = []
-    
-    for start in range(0, total_texts, BATCH_SIZE):
-        batch_texts = texts_to_translate[start:start + BATCH_SIZE]
-        batch_translated = deepl_translate_batch(batch_texts, source_lang="FR", target_lang=tgt_variant)
-        translated_texts.extend(batch_translated)
-        progress.progress(min(1.0, (start + len(batch_texts)) / total_texts), 
-                         text=f"{min(start + len(batch_texts), total_texts)}/{total_texts} segments")
-
-    # Appliquer les traductions au notebook
-    for (text_type, cell_idx, position), translated_text in zip(text_refs, translated_texts):
+    translated_texts = translate_texts(texts_to_translate, source_lang="FR", target_lang=tgt_variant, progress=progress)
+
+    # Appliquer les traductions au notebook (en partant de la fin pour que les positions
+    # des commentaires restant à remplacer dans une même cellule restent valides)
+    for (text_type, cell_idx, position), translated_text in reversed(list(zip(text_refs, translated_texts))):
         if text_type == 'markdown':
             # Remplacer le contenu markdown
-            notebook.cells[cell_idx].source = translated_text
+            notebook["cells"][cell_idx]["source"] = translated_text
         elif text_type == 'comment':
             # Remplacer le commentaire dans le code
-            cell = notebook.cells[cell_idx]
-            original_code = cell.source
+            cell = notebook["cells"][cell_idx]
+            original_code = cell["source"]
             start_pos, end_pos = position
             
             # Remplacer le commentaire dans le code original
             new_code = original_code[:start_pos] + translated_text + original_code[end_pos:]
-            cell.source = new_code
+            cell["source"] = new_code
 
     # Enregistrer le notebook traduit
     out_name = Path(in_path.name).with_suffix("")
-    out_file = tmpdir / f"{out_name}_EN.ipynb"
-    
+
+    # Validation de schéma (coûteuse) uniquement si elle est demandée
+    if validate:
+        try:
+            nbformat.validate(nbformat.from_dict(notebook))
+        except nbformat.ValidationError as e:
+            st.warning(f"Le notebook traduit ne respecte pas le schéma nbformat : {e}")
+
+    # Comme nbformat.write, 'source' est écrit sous forme de liste de lignes
+    for cell in notebook["cells"]:
+        if isinstance(cell.get("source"), str):
+            cell["source"] = cell["source"].splitlines(keepends=True)
+
     try:
-        with open(out_file, 'w', encoding='utf-8') as f:
-            nbformat.write(notebook, f)
+        data = orjson.dumps(notebook, option=orjson.OPT_INDENT_2) + b"\n"
     except Exception as e:
         st.error(f"Erreur lors de la sauvegarde du notebook : {e}")
         st.stop()
 
-    st.success("Traduction terminée. Téléchargez votre fichier ci-dessous.")
-    with open(out_file, "rb") as f:
-        st.download_button(
-            label="⬇️ Télécharger le Notebook traduit",
-            data=f.read(),
-            file_name=out_file.name,
-            mime="application/x-ipynb+json",
-        )
+    return f"{out_name}_EN.ipynb", data
 
-    # Proposer un bouton pour réinitialiser la session
+
+def show_download(file_name: str, data: bytes, label: str, mime: str):
+    """Affiche le bouton de téléchargement du fichier traduit et celui pour en traduire un autre."""
+    st.success("Traduction terminée. Téléchargez votre fichier ci-dessous.")
+    st.download_button(
+        label=label,
+        data=data,
+        file_name=file_name,
+        mime=mime,
+    )
+
+    # Proposer un bouton pour réinitialiser la session (vide le téléverseur et les résultats)
     if st.button("🔁 Traduire un autre fichier"):
-        st.experimental_rerun()
+        st.session_state["translated_files"] = {}
+        st.session_state.pop("current_result", None)
+        st.session_state["upload_round"] = st.session_state.get("upload_round", 0) + 1
+        st.rerun()
+
 
 st.set_page_config(page_title="Traduire FR → EN (DeepL)", page_icon="🌐", layout="centered")
 
@@ -323,31 +674,77 @@ elif page == "Jupyter Notebook":
     st.title("📓 Traduire un Jupyter Notebook FR → EN (DeepL)")
     st.write("Téléversez un fichier **.ipynb**. Seuls les cellules markdown et les commentaires dans le code sont traduits ; le code reste intact.")
 
-with st.expander("Paramètres avancés"):
-    tgt_variant = st.selectbox("Variante d'anglais", ["EN-US", "EN-GB"], index=0)
+# Les paramètres et le fichier sont regroupés dans un formulaire : modifier un widget ne relance
+# rien tant que l'utilisateur n'a pas cliqué sur « Traduire ».
+with st.form("translate_form"):
+    with st.expander("Paramètres avancés"):
+        tgt_variant = st.selectbox("Variante d'anglais", ["EN-US", "EN-GB"], index=0)
+        if page == "PowerPoint":
+            include_notes = st.checkbox("Traduire les notes des diapositives", value=True)
+        elif page == "Jupyter Notebook":
+            validate_notebook = st.checkbox("Valider le notebook traduit (schéma nbformat)", value=False)
+            fast_comments = st.checkbox(
+                "Extraction rapide des commentaires",
+                value=False,
+                help="À utiliser seulement si le code ne contient pas de « # » dans des chaînes de caractères.",
+            )
+
+    # La clé du téléverseur change après « Traduire un autre fichier » pour le vider
+    uploader_key = f"uploaded_{st.session_state.get('upload_round', 0)}"
     if page == "PowerPoint":
-        include_notes = st.checkbox("Traduire les notes des diapositives", value=True)
+        uploaded = st.file_uploader("Choisir un fichier PowerPoint", type=["pptx", "ppt"], key=uploader_key)
+    elif page == "Jupyter Notebook":
+        uploaded = st.file_uploader("Choisir un fichier Jupyter Notebook", type=["ipynb"], key=uploader_key)
 
-if page == "PowerPoint":
-    uploaded = st.file_uploader("Choisir un fichier PowerPoint", type=["pptx", "ppt"])
-elif page == "Jupyter Notebook":
-    uploaded = st.file_uploader("Choisir un fichier Jupyter Notebook", type=["ipynb"]) 
+    submitted = st.form_submit_button("Traduire")
 
-if uploaded is not None:
+translated_files = st.session_state.setdefault("translated_files", {})
+
+if submitted and uploaded is None:
+    st.warning("Choisissez un fichier à traduire.")
+
+if submitted and uploaded is not None:
     if not DEEPL_API_KEY:
         st.error("La variable d'environnement **DEEPL_API_KEY** n'est pas définie.")
         st.stop()
 
-    # Sauvegarder le fichier uploadé dans un dossier temporaire
-    tmpdir = Path(tempfile.mkdtemp(prefix="translate-"))
-    in_path = tmpdir / uploaded.name
-    with open(in_path, "wb") as f:
-        f.write(uploaded.getbuffer())
-
+    # Le résultat est conservé dans la session : les relances suivantes (clic sur le bouton de
+    # téléchargement, nouvelle soumission du même fichier…) ne relisent pas le fichier et ne rappellent pas DeepL.
+    file_bytes = uploaded.getvalue()
+    result_key = (
+        page,
+        hashlib.sha1(file_bytes).hexdigest(),
+        tgt_variant,
+        include_notes if page == "PowerPoint" else (validate_notebook, fast_comments),
+    )
+    if result_key not in translated_files:
+        # Sauvegarder le fichier uploadé dans un dossier temporaire (nécessaire à la conversion .ppt),
+        # supprimé dès la traduction terminée : le fichier traduit est produit en mémoire
+        with tempfile.TemporaryDirectory(prefix="translate-") as tmpdir:
+            in_path = Path(tmpdir) / uploaded.name
+            with open(in_path, "wb") as f:
+                f.write(file_bytes)
+
+            if page == "PowerPoint":
+                # Logique PowerPoint
+                result = process_powerpoint_file(in_path, tgt_variant, include_notes)
+            elif page == "Jupyter Notebook":
+                # Logique Jupyter Notebook
+                result = process_jupyter_notebook(in_path, tgt_variant, validate_notebook, fast_comments)
+        # Seul le dernier résultat est gardé en mémoire dans la session
+        translated_files = st.session_state["translated_files"] = {result_key: result}
+    st.session_state["current_result"] = result_key
+
+# Afficher le dernier fichier traduit pour cette page (y compris après une relance sans soumission)
+current_result = st.session_state.get("current_result")
+if current_result is not None and current_result[0] == page and current_result in translated_files:
+    file_name, data = translated_files[current_result]
     if page == "PowerPoint":
-        # Logique PowerPoint
-        process_powerpoint_file(in_path, tmpdir, tgt_variant, include_notes)
+        show_download(
+            file_name,
+            data,
+            label="⬇️ Télécharger le PowerPoint traduit",
+            mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
+        )
     elif page == "Jupyter Notebook":
-        # Logique Jupyter Notebook
-        process_jupyter_notebook(in_path, tmpdir, tgt_variant)
-
+        show_download(file_name, data, label="⬇️ Télécharger le Notebook traduit", mime="application/x-ipynb+json")